@@ -1,26 +1,63 @@
-from nostrmail.utils import load_contacts, get_events, get_dms, get_convs, cache
-from nostrmail.utils import publish_direct_message, email_is_logged_in, find_email_by_subject, get_encryption_iv
-from nostrmail.utils import publish_profile
+from nostrmail.utils import load_contacts, get_events, get_profiles, get_dms, get_convs, cache
+from nostrmail.utils import publish_direct_message, email_is_logged_in, find_emails_by_ivs, get_encryption_iv
+from nostrmail.utils import mail_lock
+from nostrmail.utils import publish_profile, get_shared_secret
+from nostrmail.utils import encrypt_message_with_secret, decrypt_message_with_secret
 import dash_bootstrap_components as dbc
 
 from dash import html, dcc
-import pandas as pd
 from dash.exceptions import PreventUpdate
-import json
 import os
+import atexit
+import functools
+import hmac
+import secrets
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import groupby
+from operator import itemgetter
 from nostr.key import PrivateKey
 import dash
 
-import imaplib
-from redmail import EmailSender
-from smtplib import SMTP
 
+# inboxes smaller than this are grouped without pandas
+INBOX_PANDAS_SIZE = 512
+
+# profile metadata rarely changes, so keep it on disk for a day
+PROFILE_EXPIRE = 24*60*60
+
+# email credentials are read once at startup so misconfiguration shows up at boot
+_credentials = {k: os.environ.get(k) for k in (
+    'EMAIL_ADDRESS',
+    'EMAIL_PASSWORD',
+    'IMAP_HOST',
+    'IMAP_PORT',
+    'SMTP_HOST',
+    'SMTP_PORT')}
+_missing_credentials = [k for k, v in _credentials.items() if v is None]
+if len(_missing_credentials) > 0:
+    print(f'missing email env variables: {_missing_credentials}')
+
+# logged in imap connections keyed by (imap_host, user_email), each stored
+# with a keyed digest of the password it was opened with
+_imap_pool = {}
+_imap_pool_secret = secrets.token_bytes(32)
+_imap_locks = defaultdict(threading.Lock)
+_imap_pool_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8)
+def _nsec_to_priv(priv_key_nsec):
+    """decode an nsec once and reuse the PrivateKey across callbacks"""
+    return PrivateKey.from_nsec(priv_key_nsec)
 
 
 def refresh_cache(n_clicks):
     if n_clicks > 0:
         cache.clear()
-        return f"cache cleared {pd.Timestamp.utcnow().strftime('%Y-%m-%d %X')}"
+        return f"cache cleared {datetime.now(timezone.utc).strftime('%Y-%m-%d %X')}"
     else:
         raise PreventUpdate
 
@@ -35,7 +72,7 @@ def get_triggered(ctx=None):
         button_id = ctx.triggered[0]['prop_id'].split('.')[0]
     return button_id
 
-@cache.memoize(tag='profiles') #Todo add temporal caching/refresh button
+@cache.memoize(tag='profiles', expire=PROFILE_EXPIRE)
 def load_user_profile(pub_key_hex):
     print(f'fetching profile {pub_key_hex}')
     profile_events = get_events(pub_key_hex, 'meta')
@@ -44,6 +81,32 @@ def load_user_profile(pub_key_hex):
         return profile
 
 
+def load_user_profiles(pub_key_hexes):
+    """load many profiles, fetching all cache misses in one relay query
+
+    Fetched profiles are stored under load_user_profile's memoize keys,
+    so later load_user_profile calls for these keys are cache hits
+    """
+    pub_key_hexes = set(pub_key_hexes)
+    missing = object()
+    profiles = {}
+    for pub_key_hex in pub_key_hexes:
+        profile = cache.get(load_user_profile.__cache_key__(pub_key_hex), default=missing)
+        if profile is not missing:
+            profiles[pub_key_hex] = profile
+
+    fetch = [pub_key_hex for pub_key_hex in pub_key_hexes if pub_key_hex not in profiles]
+    if len(fetch) > 0:
+        print(f'fetching {len(fetch)} profiles')
+        fetched = get_profiles(fetch)
+        for pub_key_hex in fetch:
+            profile = fetched.get(pub_key_hex)
+            cache.set(load_user_profile.__cache_key__(pub_key_hex), profile,
+                expire=PROFILE_EXPIRE, tag='profiles')
+            profiles[pub_key_hex] = profile
+    return profiles
+
+
 def update_contacts(refresh_clicks, contacts):
     if refresh_clicks is None:
         # prevent the None callbacks is important with the store component.
@@ -72,9 +135,14 @@ def update_contacts_options(ts, contacts):
 def update_contacts_table(ts, contacts):
     if None in (ts, contacts):
         raise PreventUpdate  
+    import pandas as pd
+
     df = pd.DataFrame(contacts).set_index('pubkey')
-    table = dbc.Table.from_dataframe(df, index=True)
-    return table.children
+    # to_html renders rows in pandas rather than building a component per cell
+    table = df.to_html(
+        index=True,
+        classes='table table-striped table-bordered table-hover table-dark')
+    return dcc.Markdown(table, dangerously_allow_html=True)
 
 def update_contact_profile(pubkey, contacts):
     if contacts is None:
@@ -132,7 +200,7 @@ def send_mail(
 
     try:
         # publish the dm to nostr 
-        priv_key = PrivateKey.from_nsec(user_priv_key)
+        priv_key = _nsec_to_priv(user_priv_key)
         publish_direct_message(priv_key, receiver_pub_key, dm_encrypted=subject_encrypted)
 
         # use the same dm as the email subject
@@ -148,6 +216,9 @@ def send_mail(
                     )
 
         else:
+            from redmail import EmailSender
+            from smtplib import SMTP
+
             email = EmailSender(
                 host=smtp_host,
                 port=smtp_port,
@@ -184,7 +255,7 @@ def get_nostr_pub_key(priv_key_nsec):
     if priv_key_nsec is None:
         raise PreventUpdate
     try:
-        pub_key_hex = PrivateKey.from_nsec(priv_key_nsec).public_key.hex()
+        pub_key_hex = _nsec_to_priv(priv_key_nsec).public_key.hex()
     except:
         print(f'strange priv key ----> {priv_key_nsec} <----')
         raise IOError(f'something wrong with priv key {priv_key_nsec}')
@@ -192,20 +263,10 @@ def get_nostr_pub_key(priv_key_nsec):
 
 def get_email_credentials(url):
     """if credentials are set by environment variables, use them"""
-    credentials = dict(
-        EMAIL_ADDRESS=os.environ.get('EMAIL_ADDRESS'),
-        EMAIL_PASSWORD=os.environ.get('EMAIL_PASSWORD'),
-        IMAP_HOST = os.environ.get('IMAP_HOST'),
-        IMAP_PORT = os.environ.get('IMAP_PORT'),
-        SMTP_HOST = os.environ.get('SMTP_HOST'),
-        SMTP_PORT = os.environ.get('SMTP_PORT'),
-        )
-    if None in credentials.values():
-        for k,v in credentials.items():
-            if v is None:
-                raise IOError(f'env variable {k} missing')
+    if len(_missing_credentials) > 0:
+        raise IOError(f'env variable {_missing_credentials[0]} missing')
     print('found credentials')
-    return tuple(credentials.values())
+    return tuple(_credentials.values())
 
 
 def update_receiver_address(pub_key_hex):
@@ -217,18 +278,128 @@ def update_receiver_address(pub_key_hex):
 def encrypt_message(priv_key_nsec, pub_key_hex, message):
     """encrypt message using shared secret"""
     if None not in (priv_key_nsec, pub_key_hex, message):
-        priv_key = PrivateKey.from_nsec(priv_key_nsec)
-        return priv_key.encrypt_message(message, pub_key_hex)
+        secret = get_shared_secret(_nsec_to_priv(priv_key_nsec), pub_key_hex)
+        return encrypt_message_with_secret(message, secret)
     raise PreventUpdate
 
 def decrypt_message(priv_key_nsec, pub_key_hex, encrypted_message):
     """encrypt message using shared secret"""
     if None not in (priv_key_nsec, pub_key_hex, encrypted_message):
-        priv_key = PrivateKey.from_nsec(priv_key_nsec)
-        return priv_key.decrypt_message(encrypted_message, pub_key_hex)
+        secret = get_shared_secret(_nsec_to_priv(priv_key_nsec), pub_key_hex)
+        return decrypt_message_with_secret(encrypted_message, secret)
     raise PreventUpdate
 
 
+def dm_time(created_at):
+    """naive utc datetime for a dm, displayed the same as a pandas Timestamp"""
+    return datetime.fromtimestamp(created_at, timezone.utc).replace(tzinfo=None)
+
+
+def group_conversations(dms):
+    """group dms into conversations, each sorted by time
+
+    Returns a list of (conv_id, messages) where messages are
+    (time, author, content) tuples. Typical inboxes are small enough that
+    plain python sorting beats the cost of building a DataFrame, so pandas
+    is only used past INBOX_PANDAS_SIZE messages
+    """
+    columns = ['time', 'author', 'content']
+    if len(dms) < INBOX_PANDAS_SIZE:
+        for dm in dms:
+            dm['conv'] = tuple(sorted((dm['author'], dm['p'])))
+        def message(dm):
+            return dm_time(dm['time']), dm['author'], dm['content']
+        return [(conv_id, [message(dm) for dm in conv])
+                for conv_id, conv in groupby(sorted(dms, key=itemgetter('conv', 'time')),
+                                             key=itemgetter('conv'))]
+
+    import pandas as pd
+
+    # sort once globally so each conversation group is already in time order
+    df = pd.DataFrame(dms)
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    df['conv'] = get_convs(df)
+    df = df.sort_values(['conv', 'time'])
+    return [(conv_id, list(conv[columns].itertuples(index=False, name=None)))
+            for conv_id, conv in df.groupby('conv', sort=False)]
+
+
+def render_dm_content(content, body_by_iv, secret=None):
+    """attach a dm's email body, decrypting both when a secret is given"""
+    email_body = body_by_iv.get(get_encryption_iv(content))
+    if secret is not None:
+        content = decrypt_message_with_secret(content, secret)
+        if email_body is not None:
+            email_body = decrypt_message_with_secret(email_body, secret)
+    if email_body is not None:
+        content = html.Details([
+            html.Summary(content),
+            html.Hr(),
+            dcc.Markdown(email_body.replace('\n', '<br>'),
+                dangerously_allow_html=True),])
+    return content
+
+
+@contextmanager
+def imap_connection(imap_host, user_email, user_password):
+    """yield a logged in imap connection, reused across inbox refreshes
+
+    imaplib is not thread safe, so each connection is only used while
+    holding its mail_lock, which the async helpers in utils share. A pooled
+    connection is only handed out for the password it was opened with.
+    Otherwise, or if it fails NOOP, a fresh login replaces it. A connection
+    that errors mid-use is dropped
+    """
+    key = (imap_host, user_email)
+    credential = hmac.digest(_imap_pool_secret, user_password.encode(), 'sha256')
+    with _imap_pool_lock:
+        lock = _imap_locks[key]
+    with lock:
+        mail, pooled_credential = _imap_pool.get(key, (None, None))
+        reuse = mail is not None and hmac.compare_digest(credential, pooled_credential)
+        if reuse:
+            with mail_lock(mail):
+                reuse = email_is_logged_in(mail)
+        if not reuse:
+            import imaplib
+
+            # log in before touching the pool, so a wrong password
+            # cannot evict the connection opened with the right one
+            fresh = imaplib.IMAP4_SSL(host=imap_host)
+            print('logging in')
+            try:
+                fresh.login(user_email, user_password)
+            except:
+                fresh.shutdown()
+                raise
+            if mail is not None:
+                with mail_lock(mail):
+                    try:
+                        mail.logout()
+                    except:
+                        pass
+            mail = fresh
+            _imap_pool[key] = (mail, credential)
+        with mail_lock(mail):
+            try:
+                yield mail
+            except:
+                _imap_pool.pop(key, None)
+                try:
+                    mail.logout()
+                except:
+                    pass
+                raise
+
+@atexit.register
+def _logout_imap_connections():
+    for mail, _ in _imap_pool.values():
+        try:
+            mail.logout()
+        except:
+            pass
+
+
     # input:
     #   - id: nostr-priv-key
     #     attr: value
@@ -255,20 +426,19 @@ def update_inbox(
         imap_port):
     if active_tab != 'inbox':
         raise PreventUpdate
-    # Set up connection to IMAP server
+    priv_key = _nsec_to_priv(priv_key_nsec)
+    pub_key = priv_key.public_key.hex()
+    # invalid dms carry no author or content to render
+    dms = [dm for dm in get_dms(pub_key) if dm['valid']]
+
+    # look up all email bodies up front rather than one IMAP search per dm
+    ivs = {get_encryption_iv(dm['content']) for dm in dms}
     try:
-        mail = imaplib.IMAP4_SSL(host=imap_host)
-    except:
+        with imap_connection(imap_host, user_email, user_password) as mail:
+            mail.select('Inbox')
+            body_by_iv = find_emails_by_ivs(mail, ivs)
+    except OSError:
         return html.Div(children=f'Cannot connect to imap host: {imap_host}')
-    # if not email_is_logged_in(mail):
-    print('logging in')
-    mail.login(user_email, user_password)
-    mail.select('Inbox')
-
-    priv_key = PrivateKey.from_nsec(priv_key_nsec)
-    pub_key = priv_key.public_key.hex()
-    dms = pd.DataFrame(get_dms(pub_key))
-    dms['conv'] = get_convs(dms)
 
     dms_render = []
     style = dict(
@@ -277,73 +447,49 @@ def update_inbox(
           height="50px",
           borderRadius="50%",
           backgroundRepeat="no-repeat",
-          backgroundRosition="center center",
+          backgroundPosition="center center",
           backgroundSize="cover")
 
-    for conv_id, conv in dms.groupby('conv'):
-        # print(f'conv id: {conv_id}')
-        conv.set_index('time', inplace=True)
-        conv.sort_index(ascending=True, inplace=True)
-        msg_list = []
-        for _, msg in conv.iterrows():
-            # print(f' msg id: {_}')
-            profile = load_user_profile(msg.author)
-            style_ = style.copy()
-            try:
-                style_.update(backgroundImage=f"url({profile['picture']})")
-            except:
-                raise IOError(f'could not extract picture from {profile} author: {msg.author}')
-            content = msg['content']
-            msg_iv = get_encryption_iv(content)
-            email_body = find_email_by_subject(mail, msg_iv)
-
-            if decrypt:
-                if msg.author == pub_key: # sent from the user
-                    content = priv_key.decrypt_message(content, msg['p'])
-                    if email_body is not None:
-                        email_body = priv_key.decrypt_message(email_body, msg['p'])
-                else: # sent to the user
-                    content = priv_key.decrypt_message(content, msg.author)
-                    if email_body is not None:
-                        email_body = priv_key.decrypt_message(email_body, msg.author)
-            if email_body is not None:
-                content = html.Details([
-                    html.Summary(content),
-                    html.Hr(),
-                    dcc.Markdown(email_body.replace('\n', '<br>'),
-                        dangerously_allow_html=True),])
-
-            if msg.author == pub_key: # sent from the user
-                msg_list.append(
-                    dbc.ListGroup([
-                            dbc.ListGroupItem(html.Div(style=style.copy())),
-                            dbc.ListGroupItem(content, n_clicks=0, action=True),
-                            dbc.ListGroupItem(str(_)),
-                            dbc.ListGroupItem(html.Div(style=style_.copy())),],
-                        horizontal=True)
-                    )
-            else: # sent to the user
-                msg_list.append(
-                    dbc.ListGroup([
-                            dbc.ListGroupItem(html.Div(style=style_.copy())),
-                            dbc.ListGroupItem(content, n_clicks=0, action=True),
-                            dbc.ListGroupItem(str(_)),
-                            dbc.ListGroupItem(html.Div(style=style.copy())),
-                            ],
-                        horizontal=True)
-                    )   
-
-        # print('appending messages')
-        dms_render.append(dbc.Row(dbc.Col(msg_list)))
+    profiles = load_user_profiles({dm['author'] for dm in dms})
 
-    # Close the mailbox and logout from the IMAP server
-    if email_is_logged_in(mail):
-        print('logging out')
+    # styles are shared between rows since the components never mutate them
+    avatar_styles = {}
+    for author, profile in profiles.items():
         try:
-            mail.close()
-            mail.logout()
+            avatar_styles[author] = {**style, 'backgroundImage': f"url({profile['picture']})"}
         except:
-            pass
+            raise IOError(f'could not extract picture from {profile} author: {author}')
+
+    # received messages show the sender's avatar on the left (index 0),
+    # sent messages show the user's avatar on the right (index 1)
+    orders = (
+        lambda content, time, style_: [
+            dbc.ListGroupItem(html.Div(style=style_)),
+            dbc.ListGroupItem(content, n_clicks=0, action=True),
+            dbc.ListGroupItem(time),
+            dbc.ListGroupItem(html.Div(style=style))],
+        lambda content, time, style_: [
+            dbc.ListGroupItem(html.Div(style=style)),
+            dbc.ListGroupItem(content, n_clicks=0, action=True),
+            dbc.ListGroupItem(time),
+            dbc.ListGroupItem(html.Div(style=style_))],
+        )
+
+    for conv_id, conv in group_conversations(dms):
+        secret = None
+        if decrypt:
+            # every message in a conversation shares the same ecdh secret
+            other = conv_id[1] if conv_id[0] == pub_key else conv_id[0]
+            secret = get_shared_secret(priv_key, other)
+        msg_list = [
+            dbc.ListGroup(
+                orders[author == pub_key](
+                    render_dm_content(content, body_by_iv, secret),
+                    str(time),
+                    avatar_styles[author]),
+                horizontal=True)
+            for time, author, content in conv]
+        dms_render.append(dbc.Row(dbc.Col(msg_list)))
 
     return dms_render
 
@@ -384,7 +530,7 @@ def update_user_profile(n_clicks, priv_key_nsec, profile_keys, profile_values):
     for k, v in zip(profile_keys, profile_values):
         profile[k] = v
 
-    priv_key = PrivateKey.from_nsec(priv_key_nsec)
+    priv_key = _nsec_to_priv(priv_key_nsec)
     sig = publish_profile(priv_key, profile)
 
     return sig
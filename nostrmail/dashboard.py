@@ -6,15 +6,28 @@ from psidash.psidash import load_app, load_conf, load_dash, load_components, get
 # could use flask login for added layer of security
 # from flask_login import LoginManager, UserMixin
 import flask
+import plotly.io as pio
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import pathlib
+from nostrmail.utils import get_crypto_acceleration
 
 
 this_dir = pathlib.Path(__file__).parent.resolve()
 
 conf = load_conf(f'{this_dir}/dashboard.yaml')
 
+# dash serializes callback outputs through plotly's json encoder
+pio.json.config.default_engine = 'orjson'
+
+try:
+    openssl_version, missing_flags = get_crypto_acceleration()
+    print(f'crypto backend: {openssl_version}')
+    if missing_flags:
+        print(f'warning: cpu lacks {missing_flags}, encryption falls back to slower code paths')
+except Exception as m:
+    print(f'could not probe crypto backend: {m}')
+
 server = flask.Flask(__name__, # define flask app.server
     static_url_path='', # remove /static/ from url prefixes
     static_folder='static',
@@ -3,29 +3,53 @@ from nostr.key import PrivateKey
 import json
 import ssl
 import time
-from nostr.relay_manager import RelayManager
-from nostr.key import PrivateKey
-
-import json
-import ssl
-import time
+import orjson
+import asyncio
+import queue
+import threading
+import uuid
+import weakref
 from nostr.filter import Filter, Filters
 from nostr.event import Event, EventKind
 from nostr.relay_manager import RelayManager
-from nostr.message_type import ClientMessageType
+from nostr.message_type import ClientMessageType, RelayMessageType
+from nostr.message_pool import EventMessage, EndOfStoredEventsMessage
+import re
 import requests
 from omegaconf import OmegaConf
-import pandas as pd
+import numpy as np
 import os
 from diskcache import FanoutCache
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import functools
+import hashlib
 import base64
+import binascii
+import secrets
 import email
+from email.header import decode_header, make_header
 
 cache_dir = os.environ.get('NOSTRMAIL_CACHE', 'cache')
 
 print(f'cache_dir: {cache_dir}')
-cache = FanoutCache(cache_dir, size_limit=1e6) # 1Mb
+# profiles, nip05 lookups and blocks share this cache, so size it for all of them
+cache = FanoutCache(cache_dir, shards=8, size_limit=int(256e6), # 256Mb
+                    eviction_policy='least-recently-used')
+
+# nip05 registrations can change, so only trust a lookup for an hour
+NIP05_EXPIRE = 60*60
+
+# nip05 domains that are worth fetching
+_DOMAIN_RE = re.compile(r'[A-Za-z0-9.-]+')
+
+# keep-alive connections for blockstream and nip05 lookups, with room for
+# the concurrent fetches in get_blocks_async to each hold a connection
+HTTP_TIMEOUT = 5
+http_session = requests.Session()
+http_adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
 
 nostr_contacts = os.environ.get('NOSTR_CONTACTS')
 
@@ -37,47 +61,261 @@ else:
         "wss://relay.damus.io"]
 
 
-def get_events(pub_key_hex, kind='text', relays=relays, returns='content'):
-    relay_manager = RelayManager()
+class RelayPool:
+    """long-lived connections to a set of relays, shared by every query
 
-    for relay in relays:
-        relay_manager.add_relay(relay)
+    Opening a relay costs a TLS and websocket handshake, so connections stay
+    open between calls. Dropped relays are reopened on the next call, with
+    exponential backoff between attempts. Each relay's websocket routes
+    incoming events and end of stored events notices to the queue of the
+    subscription that asked for them, in the order the relay sent them, so
+    concurrent callers can share the same connections
+    """
+
+    def __init__(self, relays, open_timeout=1.25, max_backoff=60):
+        self.relay_manager = RelayManager()
+        for relay in relays:
+            # add_relay's default subscriptions dict is shared by every relay,
+            # so closing a subscription would pop it twice from the same dict
+            self.relay_manager.add_relay(relay, subscriptions={})
+        self._opened = {}
+        for url, relay in self.relay_manager.relays.items():
+            self._opened[url] = threading.Event()
+            relay.ws.on_open = self._on_open(self._opened[url], relay.ws.on_open)
+            relay.ws.on_message = self._on_message(relay, relay.ws.on_message)
+        self.open_timeout = open_timeout
+        self.max_backoff = max_backoff
+        self._threads = {}
+        self._failures = {url: 0 for url in self.relay_manager.relays}
+        self._retry_at = {url: 0 for url in self.relay_manager.relays}
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _on_open(opened, on_open):
+        """wrap a websocket on_open callback to also signal opened"""
+        def wrapper(ws):
+            opened.set()
+            if on_open is not None:
+                on_open(ws)
+        return wrapper
+
+    def _on_message(self, relay, on_message):
+        """wrap a websocket on_message callback to route frames itself
+
+        The message pool drops every event id it has seen on any
+        subscription, which on long-lived connections hides events from
+        repeat and concurrent queries, and it queues end of stored events
+        notices apart from events, losing the order a relay sent them in.
+        Events are validated as before, which checks their signatures and
+        filters, then put straight on their subscription's queue along with
+        eose notices, and duplicates across relays are dropped per
+        subscription instead. Notices are logged rather than left to pile up
+        in the pool. Everything else still goes through on_message
+        """
+        def wrapper(ws, message):
+            try:
+                frame = orjson.loads(message)
+                message_type = frame[0]
+            except (orjson.JSONDecodeError, IndexError, TypeError):
+                return
+            if message_type == RelayMessageType.EVENT:
+                if not relay._is_valid_message(message):
+                    return
+                subscription_id, e = frame[1], frame[2]
+                messages = self._subscriptions.get(subscription_id)
+                if messages is None:
+                    return
+                event = Event(e['pubkey'], e['content'],
+                    created_at=e['created_at'], kind=e['kind'], tags=e['tags'], signature=e['sig'])
+                messages.put(EventMessage(event, subscription_id, relay.url))
+            elif message_type == RelayMessageType.END_OF_STORED_EVENTS:
+                messages = self._subscriptions.get(frame[1])
+                if messages is not None:
+                    messages.put(EndOfStoredEventsMessage(frame[1], relay.url))
+            elif message_type == RelayMessageType.NOTICE:
+                print(f'notice from {relay.url}: {frame[1:]}')
+            elif on_message is not None:
+                on_message(ws, message)
+        return wrapper
+
+    @staticmethod
+    def _is_open(relay):
+        sock = getattr(relay.ws, 'sock', None)
+        return sock is not None and sock.connected
+
+    def connect(self):
+        """open any relay that is not connected and wait for it to open"""
+        with self._lock:
+            now = time.time()
+            opening = []
+            for url, relay in self.relay_manager.relays.items():
+                thread = self._threads.get(url)
+                if thread is not None and thread.is_alive():
+                    continue
+                if now < self._retry_at[url]:
+                    continue
+                self._retry_at[url] = now + min(self.max_backoff, 2**self._failures[url])
+                self._failures[url] += 1
+                self._opened[url].clear()
+                # NOTE: This disables ssl certificate verification
+                thread = threading.Thread(
+                    target=relay.connect,
+                    args=({"cert_reqs": ssl.CERT_NONE},),
+                    name=f'{url}-thread',
+                    daemon=True)
+                thread.start()
+                self._threads[url] = thread
+                opening.append(url)
+
+            deadline = now + self.open_timeout
+            for url in opening:
+                self._opened[url].wait(max(0, deadline - time.time()))
+            for url, relay in self.relay_manager.relays.items():
+                if self._is_open(relay):
+                    self._failures[url] = 0
+
+    def _send(self, message):
+        """send message to every open relay, returning how many were sent to"""
+        sent = 0
+        for relay in self.relay_manager.relays.values():
+            if not self._is_open(relay):
+                continue
+            try:
+                relay.publish(message)
+                sent += 1
+            except Exception as m:
+                print(f'could not send to {relay.url}: {m}')
+        return sent
+
+    def stream(self, filters, timeout=3):
+        """subscribe to filters and yield event messages as they arrive
+
+        One message is yielded per event id, until every relay the request
+        went to has sent end of stored events or timeout seconds pass.
+        The subscription is closed once the generator finishes or is closed
+        """
+        self.connect()
+        subscription_id = uuid.uuid4().hex
+        messages = queue.Queue()
+        self._subscriptions[subscription_id] = messages
+        self.relay_manager.add_subscription(subscription_id, filters)
+
+        request = [ClientMessageType.REQUEST, subscription_id]
+        request.extend(filters.to_json_array())
+        seen = set()
+        finished = set()
+        try:
+            sent = self._send(orjson.dumps(request).decode())
+            deadline = time.time() + timeout
+            while len(finished) < sent:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    message = messages.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if isinstance(message, EndOfStoredEventsMessage):
+                    finished.add(message.url)
+                elif message.event.id not in seen:
+                    seen.add(message.event.id)
+                    yield message
+        finally:
+            del self._subscriptions[subscription_id]
+            self._send(orjson.dumps([ClientMessageType.CLOSE, subscription_id]).decode())
+            self.relay_manager.close_subscription(subscription_id)
+
+    def request(self, filters, timeout=3):
+        """subscribe to filters and return all event messages received"""
+        return list(self.stream(filters, timeout))
+
+    def publish(self, event):
+        """publish a signed event to every open relay"""
+        self.connect()
+        event_json = dict(
+            id=event.id,
+            pubkey=event.public_key,
+            created_at=event.created_at,
+            kind=event.kind,
+            tags=event.tags,
+            content=event.content,
+            sig=event.signature)
+        sent = self._send(orjson.dumps([ClientMessageType.EVENT, event_json]).decode())
+        if sent == 0:
+            raise IOError('could not publish event, no relays are connected')
+
+
+relay_pools = {}
+relay_pools_lock = threading.Lock()
+
+def get_relay_pool(relays=relays):
+    """the shared RelayPool for this list of relays"""
+    key = tuple(relays)
+    with relay_pools_lock:
+        if key not in relay_pools:
+            relay_pools[key] = RelayPool(key)
+        return relay_pools[key]
+
+
+def get_filters(pub_key_hex, kind):
+    """build subscription filters for events of the given kind"""
+    if isinstance(pub_key_hex, str):
+        pub_key_hexes = [pub_key_hex]
+    else:
+        pub_key_hexes = list(pub_key_hex)
 
-    events = []
     if kind == 'text':
         kinds = [EventKind.TEXT_NOTE]
-        filter_ = Filter(authors=[pub_key_hex], kinds=kinds)
+        filter_ = Filter(authors=pub_key_hexes, kinds=kinds)
         filters = Filters([filter_])
     elif kind == 'meta':
         kinds = [EventKind.SET_METADATA]
-        filter_ = Filter(authors=[pub_key_hex], kinds=kinds)
+        filter_ = Filter(authors=pub_key_hexes, kinds=kinds)
         filters = Filters([filter_])
     elif kind == 'dm':
         kinds = [EventKind.ENCRYPTED_DIRECT_MESSAGE]
-        filter_to_pub_key = Filter(pubkey_refs=[pub_key_hex], kinds=kinds)
-        filter_from_pub_key = Filter(authors=[pub_key_hex], kinds=kinds)
+        filter_to_pub_key = Filter(pubkey_refs=pub_key_hexes, kinds=kinds)
+        filter_from_pub_key = Filter(authors=pub_key_hexes, kinds=kinds)
         filters = Filters([filter_to_pub_key, filter_from_pub_key])
     else:
         raise NotImplementedError(f'{kind} events not supported')
-    
-    subscription_id = "some random str"
-    request = [ClientMessageType.REQUEST, subscription_id]
-    request.extend(filters.to_json_array())
+    return filters
+
+def get_events_stream(pub_key_hex, kind='text', relays=relays):
+    """yield events of the given kind for pub_key_hex as relays send them
 
+    Events are deduplicated by id but arrive in no particular order, so
+    callers can start on the first events while the rest are in flight
+    """
+    for event_msg in get_relay_pool(relays).stream(get_filters(pub_key_hex, kind)):
+        yield event_msg.event
 
-    relay_manager.add_subscription(subscription_id, filters)
-    relay_manager.open_connections({"cert_reqs": ssl.CERT_NONE}) # NOTE: This disables ssl certificate verification
-    time.sleep(1.25) # allow the connections to open
+def get_events(pub_key_hex, kind='text', relays=relays, returns='content'):
+    """fetch events of the given kind for pub_key_hex, newest first
 
-    message = json.dumps(request)
-    relay_manager.publish_message(message)
-    time.sleep(1) # allow the messages to send
+    pub_key_hex may also be a list of pub keys, which are all queried
+    in a single subscription. Events are deduplicated by id, and meta
+    events are reduced to the latest one per author
+    """
+    events = []
+    event_msgs = get_relay_pool(relays).request(get_filters(pub_key_hex, kind))
+    event_msgs.sort(key=lambda event_msg: event_msg.event.created_at, reverse=True)
+    seen = set()
+    for event_msg in event_msgs:
+        # metadata is replaceable, so only the newest event per author counts.
+        # skip the rest before paying for any json decoding
+        if kind == 'meta':
+            key = event_msg.event.public_key
+        else:
+            key = event_msg.event.id
+        if key in seen:
+            continue
+        seen.add(key)
 
-    while relay_manager.message_pool.has_events():
-        event_msg = relay_manager.message_pool.get_event()
         if returns == 'content':
             if kind == 'meta':
-                content = json.loads(event_msg.event.content)
+                content = orjson.loads(event_msg.event.content)
             else:
                 content = event_msg.event.content
         elif returns == 'event':
@@ -86,9 +324,28 @@ def get_events(pub_key_hex, kind='text', relays=relays, returns='content'):
             raise NotImplementedError(f"{returns} returns option not supported, options are 'event' or 'content'")
         events.append(content)
 
-    relay_manager.close_connections()
     return events
 
+def get_profiles(pub_key_hexes):
+    """fetch metadata for many pub keys with one relay subscription
+
+    Returns a dict mapping pub key to its latest profile. Keys without
+    metadata (or with undecodable metadata) are omitted
+    """
+    profiles = {}
+    # get_events already keeps only the newest meta event per author
+    for event in get_events(list(pub_key_hexes), 'meta', returns='event'):
+        try:
+            profiles[event.public_key] = orjson.loads(event.content)
+        except orjson.JSONDecodeError:
+            continue
+    return profiles
+
+async def run_blocking(func, *args, **kwargs):
+    """await a blocking call on the event loop's default executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
 def publish_direct_message(priv_key, receiver_pub_key_hex, clear_text=None, dm_encrypted=None, event_id=None):
     """publish a direct message sent from priv_key to receiver_pub_key_hex
 
@@ -100,19 +357,12 @@ def publish_direct_message(priv_key, receiver_pub_key_hex, clear_text=None, dm_e
         if clear_text is None:
             raise IOError('Must provide clear_text if dm is not precomputed')
         else:
-            dm_encrypted = priv_key.encrypt_message(clear_text, receiver_pub_key_hex)
+            dm_encrypted = encrypt_message_with_secret(
+                clear_text, get_shared_secret(priv_key, receiver_pub_key_hex))
     else:
         # assumes the dm was precomputed and receiver can decrypt it
         pass
 
-    relay_manager = RelayManager()
-
-    for relay in relays:
-        relay_manager.add_relay(relay)
-    relay_manager.open_connections({"cert_reqs": ssl.CERT_NONE}) # NOTE: This disables ssl certificate verification
-    print('waiting 1 sec to open')
-    time.sleep(1)
-    
     if event_id is None:
         tags=[['p', receiver_pub_key_hex]]
     else:
@@ -126,40 +376,89 @@ def publish_direct_message(priv_key, receiver_pub_key_hex, clear_text=None, dm_e
                 )
     priv_key.sign_event(dm_event)
 
-    assert dm_event.verify()
+    # we just signed it, so only re-verify when debugging the signer
+    if __debug__ and os.environ.get('NOSTRMAIL_VERIFY_OWN'):
+        assert dm_event.verify()
 
-    relay_manager.publish_event(dm_event)
-    print('waiting 1 sec to send')
-    time.sleep(1) # allow the messages to send
-
-    relay_manager.close_connections()
+    get_relay_pool().publish(dm_event)
     return dm_event.signature
 
+def get_crypto_acceleration():
+    """report the OpenSSL build and any cpu crypto extensions it cannot use
+
+    Returns (openssl_version, missing_flags). missing_flags lists which of
+    aes, avx2 and sha_ni are absent, or is None if cpu flags are unreadable
+    """
+    from cryptography.hazmat.backends.openssl.backend import backend
+    version = backend.openssl_version_text()
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line for line in f if line.startswith('flags')), None)
+    except OSError:
+        flags = None
+    if flags is None:
+        return version, None
+    flags = set(flags.split(':', 1)[1].split())
+    return version, [flag for flag in ('aes', 'avx2', 'sha_ni') if flag not in flags]
+
+@functools.lru_cache(maxsize=256)
+def _shared_secret(raw_secret, pub_key_hex):
+    return PrivateKey(raw_secret).compute_shared_secret(pub_key_hex)
+
+def get_shared_secret(priv_key, pub_key_hex):
+    """ECDH shared secret between priv_key and pub_key_hex
+
+    The secp256k1 multiplication is cached per key pair, since every
+    message in a conversation uses the same secret
+    """
+    return _shared_secret(priv_key.raw_secret, pub_key_hex)
+
+def encrypt_message_with_secret(message, shared_secret):
+    """encrypt a NIP-04 message using a precomputed shared secret"""
+    data = message.encode()
+    length = len(data)
+    # pkcs7: fill one buffer with the pad byte, then copy the message over it
+    pad_length = 16 - length % 16
+    padded_data = bytearray([pad_length]) * (length + pad_length)
+    padded_data[:length] = data
+    iv = secrets.token_bytes(16)
+    encryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).encryptor()
+    encrypted_message = encryptor.update(memoryview(padded_data)) + encryptor.finalize()
+    encoded_content = binascii.b2a_base64(encrypted_message, newline=False).decode()
+    encoded_iv = binascii.b2a_base64(iv, newline=False).decode()
+    return f"{encoded_content}?iv={encoded_iv}"
+
+def decrypt_message_with_secret(encrypted_message, shared_secret):
+    """decrypt a NIP-04 message using a precomputed shared secret"""
+    encoded_content, encoded_iv = encrypted_message.split('?iv=')
+    iv = binascii.a2b_base64(encoded_iv)
+    decryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).decryptor()
+    padded_data = decryptor.update(binascii.a2b_base64(encoded_content)) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return (unpadder.update(padded_data) + unpadder.finalize()).decode()
+
 def get_dms(pub_key_hex):
     """Get all dms for this pub key
     Returns list of dict objects storing metadata for each dm
-    Note: if a dm signature does not pass, the event is markded with valid=False
+    Note: relays' events are signature checked on arrival and dropped if
+    they fail, so every dm returned is marked valid=True
+    time is left as unix seconds so callers can convert a whole column at once
     """
     dms = []
-    dm_events = get_events(pub_key_hex, kind='dm', returns='event')
-    for e in dm_events:
-        # check signature first
-        if not e.verify():
-            dm = dict(valid=False, event_id=e.id)
+    for e in get_events(pub_key_hex, kind='dm', returns='event'):
+        dm = dict(
+            valid=True,
+            time=e.created_at,
+            event_id=e.id,
+            author=e.public_key,
+            content=e.content,
+            **dict(e.tags))
+        if dm['p'] == pub_key_hex:
+            pass
+        elif dm['author'] == pub_key_hex:
+            pass
         else:
-            dm = dict(
-                valid=True,
-                time=pd.Timestamp(e.created_at, unit='s'),
-                event_id=e.id,
-                author=e.public_key,
-                content=e.content,
-                **dict(e.tags))
-            if dm['p'] == pub_key_hex:
-                pass
-            elif dm['author'] == pub_key_hex:
-                pass
-            else:
-                raise AssertionError('pub key not associated with dm')
+            raise AssertionError('pub key not associated with dm')
         dms.append(dm)
     return dms
 
@@ -169,28 +468,35 @@ def get_convs(dms):
     dms - pd.DataFrame of dms
     
     """
-    convs = []
-    for _, e in dms.iterrows():
-        convs.append(tuple(sorted((e.author, e.p))))
-    return convs
+    return list(map(tuple, np.sort(dms[['author', 'p']].values, axis=1)))
+
+@cache.memoize(typed=True, tag='nip05', expire=NIP05_EXPIRE)
+def fetch_nip05_json(tld, username):
+    """fetch the nostr.json a nip05 domain serves for username"""
+    url = f'https://{tld}/.well-known/nostr.json?name={username}'
+    result = http_session.get(url, timeout=HTTP_TIMEOUT)
+    try:
+        return json.loads(result.content.decode('utf-8'))
+    except json.JSONDecodeError:
+        raise NameError('Cannot decode nip05 json')
 
+@cache.memoize(typed=True, tag='nip05', expire=NIP05_EXPIRE)
 def validate_nip05(hex_name):
+    """return the nip05 name registered to hex_name, False if it has none
+
+    Raises NameError if the nip05 domain does not vouch for hex_name.
+    Exceptions are never memoized, so failed lookups are retried next call
+    """
     meta = get_events(hex_name, 'meta')
     nip05 = meta[0].get('nip05')
     if nip05 is None:
         return False
-    # construct get request
-    if '@' in nip05:
-        username, tld = nip05.split('@')
-    else:
+    # skip the request entirely for malformed identifiers
+    username, sep, tld = nip05.partition('@')
+    if not sep or not _DOMAIN_RE.fullmatch(tld):
         return False
-    
-    url = f'https://{tld}/.well-known/nostr.json?name={username}'
-    result = requests.get(url)
-    try:
-        nip05_data = json.loads(result.content.decode('utf-8'))
-    except JSONDecodeError:
-        raise NameError('Cannot decode nip05 json')
+
+    nip05_data = fetch_nip05_json(tld, username)
     if 'names' in nip05_data:
         names = nip05_data['names']
         # reverse lookup
@@ -201,8 +507,6 @@ def validate_nip05(hex_name):
             raise NameError(f'{hex_name} not among registered pub keys: {pubs}')
     else:
         raise NameError('nip05 data does not contain names')
-    
-    return result
 
 
 def load_contacts(contacts_file=nostr_contacts):
@@ -211,26 +515,15 @@ def load_contacts(contacts_file=nostr_contacts):
 
 
 def publish_profile(priv_key, profile_dict):
-    relay_manager = RelayManager()
-
-    for relay in relays:
-        relay_manager.add_relay(relay)
-    relay_manager.open_connections({"cert_reqs": ssl.CERT_NONE}) # NOTE: This disables ssl certificate verification
-    print('waiting 1.5 sec to open')
-    time.sleep(1.5)
-    
     event_profile = Event(priv_key.public_key.hex(),
                           json.dumps(profile_dict),
                           kind=EventKind.SET_METADATA)
     priv_key.sign_event(event_profile)
     
-    # check signature
-    assert event_profile.verify()
-    relay_manager.publish_event(event_profile)
-    print('waiting 1 sec to send')
-    time.sleep(1) # allow the messages to send
-
-    relay_manager.close_connections()
+    # we just signed it, so only re-verify when debugging the signer
+    if __debug__ and os.environ.get('NOSTRMAIL_VERIFY_OWN'):
+        assert event_profile.verify()
+    get_relay_pool().publish(event_profile)
     return event_profile.signature
 
 
@@ -238,10 +531,13 @@ def publish_profile(priv_key, profile_dict):
 def sha256(message):
     if message is None:
         return ''
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(message.encode())
+    return sha256_bytes(message.encode())
+
+def sha256_bytes(message):
+    """sha256 for callers that already hold bytes, skipping the encode"""
+    digest = hashlib.sha256(message)
     digest.update(b"123")
-    return base64.urlsafe_b64encode(digest.finalize()).decode('ascii')
+    return base64.urlsafe_b64encode(digest.digest()).decode('ascii')
 
 def email_is_logged_in(mail):
     try:
@@ -254,38 +550,90 @@ def get_encryption_iv(msg):
     return msg.split('?iv=')[-1].strip('==')
 
 def find_email_by_subject(mail, subject):
-    # Search for emails matching a specific subject
+    """return the body of the first email whose subject contains subject"""
     result, data = mail.search(None, f'SUBJECT "{subject}"')
-    
-    # Process the list of message IDs returned by the search
-    for num in data[0].split():
-        # Fetch the email message by ID
-        result, data = mail.fetch(num, '(RFC822)')
-        raw_email = data[0][1]
-        # Convert raw email data into a Python email object
-        email_message = email.message_from_bytes(raw_email)
-        # Extract the email subject and print it
-        subject = email_message['Subject'].strip()
-#         print(f"Email subject: {subject}")
-    
-        # Extract the email body and print it
-        if email_message.is_multipart():
-#             print('found multipart')
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                if content_type == 'text/plain':
-                    email_body = part.get_payload(decode=True).decode()
-                    break
-        else:
-#             print('normal email')
-            email_body = email_message.get_payload(decode=True).decode()
-#         print(f"Email body: {email_body}")
+    nums = data[0].split()
+    if len(nums) == 0:
+        return None
+    # only the first match is used, so fetch just that one without marking it read
+    result, data = mail.fetch(nums[0], '(BODY.PEEK[])')
+    email_body = _email_body(email.message_from_bytes(data[0][1]))
+    if email_body is not None:
         return email_body.strip()
 
 
+def _email_body(email_message):
+    """extract the text/plain body of an email message"""
+    if email_message.is_multipart():
+        for part in email_message.walk():
+            if part.get_content_type() == 'text/plain':
+                return part.get_payload(decode=True).decode()
+    else:
+        return email_message.get_payload(decode=True).decode()
+
+def find_emails_by_ivs(mail, ivs, chunk_size=50):
+    """find email bodies for many encryption ivs at once
+
+    Subjects are searched in chunks of OR'd criteria so that each chunk costs
+    one SEARCH and one FETCH round-trip instead of one pair per message.
+    Returns a dict mapping iv to email body, ivs without a match are omitted
+    """
+    ivs = list(ivs)
+    bodies = {}
+    for i in range(0, len(ivs), chunk_size):
+        criteria = [f'SUBJECT "{iv}"' for iv in ivs[i:i + chunk_size]]
+        # OR takes exactly two search keys, so nest them in prefix form
+        query = criteria[-1]
+        for criterion in reversed(criteria[:-1]):
+            query = f'OR {criterion} {query}'
+        result, data = mail.search(None, query)
+        nums = data[0].split()
+        if len(nums) == 0:
+            continue
+        result, data = mail.fetch(b','.join(nums), '(BODY.PEEK[])')
+        for item in data:
+            if not isinstance(item, tuple):
+                # closing parenthesis of each fetch response
+                continue
+            email_message = email.message_from_bytes(item[1])
+            subject = str(make_header(decode_header(email_message['Subject'])))
+            iv = get_encryption_iv(''.join(subject.split()))
+            # keep the first match, as find_email_by_subject does
+            if iv not in bodies:
+                body = _email_body(email_message)
+                if body is not None:
+                    bodies[iv] = body.strip()
+    return bodies
+
+# an imap connection can only run one command at a time, whether it is driven
+# from a callback thread or an event loop, so every caller takes this lock
+_mail_locks = weakref.WeakKeyDictionary()
+_mail_locks_lock = threading.Lock()
+
+def mail_lock(mail):
+    """the lock serializing commands on an imap connection"""
+    with _mail_locks_lock:
+        lock = _mail_locks.get(mail)
+        if lock is None:
+            lock = _mail_locks[mail] = threading.Lock()
+        return lock
+
+def _locked_mail_call(func, mail, *args):
+    with mail_lock(mail):
+        return func(mail, *args)
+
+async def email_is_logged_in_async(mail):
+    """awaitable email_is_logged_in, run off the event loop"""
+    return await run_blocking(_locked_mail_call, email_is_logged_in, mail)
+
+async def find_email_by_subject_async(mail, subject):
+    """awaitable find_email_by_subject, run off the event loop"""
+    return await run_blocking(_locked_mail_call, find_email_by_subject, mail, subject)
+
+
 @cache.memoize(typed=True, tag='block_height')
 def get_block_hash(block_height):
-    result = requests.get(f'https://blockstream.info/api/block-height/{block_height}').content.decode('utf-8')
+    result = http_session.get(f'https://blockstream.info/api/block-height/{block_height}', timeout=HTTP_TIMEOUT).content.decode('utf-8')
     return result
 
 
@@ -300,10 +648,14 @@ def get_block_info(block_height=None, block_hash=None):
         # this needs to raise an error to prevent cache from storing it
         raise ValueError('Block not found')
     print(f'getting block {block_hash}')
-    result = requests.get(f'https://blockstream.info/api/block/{block_hash}')
+    result = http_session.get(f'https://blockstream.info/api/block/{block_hash}', timeout=HTTP_TIMEOUT)
     return result.json()
 
 def get_latest_block_hash():
-    block_hash = requests.get('https://blockstream.info/api/blocks/tip/hash').content.decode('utf-8')
+    block_hash = http_session.get('https://blockstream.info/api/blocks/tip/hash', timeout=HTTP_TIMEOUT).content.decode('utf-8')
     return block_hash
 
+async def get_blocks_async(block_heights):
+    """fetch info for many blocks concurrently, through get_block_info's cache"""
+    return await asyncio.gather(
+        *[run_blocking(get_block_info, block_height=block_height) for block_height in block_heights])
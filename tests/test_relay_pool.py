@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import threading
+
+import pytest
+
+os.environ.setdefault('NOSTRMAIL_CACHE', tempfile.mkdtemp())
+pytest.importorskip('nostr')
+utils = pytest.importorskip('nostrmail.utils')
+
+from nostr.event import Event, EventKind
+from nostr.filter import Filter, Filters
+from nostr.key import PrivateKey
+
+
+class FakeSocket:
+    connected = True
+
+
+def fake_websocket(relay, events):
+    """answer every REQ on relay's websocket with events, then EOSE"""
+    ws = relay.ws
+    closed = threading.Event()
+
+    def run_forever(*args, **kwargs):
+        ws.sock = FakeSocket()
+        ws.on_open(ws)
+        closed.wait()
+
+    def send(message):
+        frame = json.loads(message)
+        if frame[0] == 'REQ':
+            for event in events:
+                ws.on_message(ws, json.dumps(['EVENT', frame[1], event]))
+            ws.on_message(ws, json.dumps(['EOSE', frame[1]]))
+
+    ws.run_forever = run_forever
+    ws.send = send
+    return closed
+
+
+def signed_event(priv_key, content):
+    event = Event(priv_key.public_key.hex(), content, kind=EventKind.TEXT_NOTE)
+    priv_key.sign_event(event)
+    return dict(
+        id=event.id,
+        pubkey=event.public_key,
+        created_at=event.created_at,
+        kind=event.kind,
+        tags=event.tags,
+        content=event.content,
+        sig=event.signature)
+
+
+def test_stream_through_relays():
+    priv_key = PrivateKey()
+    events = [signed_event(priv_key, f'note {i}') for i in range(3)]
+    pool = utils.RelayPool(['wss://relay.one', 'wss://relay.two'])
+    closers = [fake_websocket(relay, events) for relay in pool.relay_manager.relays.values()]
+    filters = Filters([Filter(authors=[priv_key.public_key.hex()], kinds=[EventKind.TEXT_NOTE])])
+    try:
+        # repeat queries must work, so closing a subscription cannot raise
+        for _ in range(2):
+            event_msgs = pool.request(filters)
+            assert sorted(msg.event.id for msg in event_msgs) == sorted(e['id'] for e in events)
+            assert pool._subscriptions == {}
+            for relay in pool.relay_manager.relays.values():
+                assert relay.subscriptions == {}
+    finally:
+        for closed in closers:
+            closed.set()